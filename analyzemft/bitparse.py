@@ -9,33 +9,24 @@
 #
 
 
+# int.from_bytes does the little endian decode (and the two's complement) in C, rather than a loop per byte
+
 def parse_little_endian_signed_positive(buf):
-    ret = 0
-    for i, b in enumerate(buf):
-        ret += b * (1 << (i * 8))
-    return ret
+    return int.from_bytes(buf, 'little')
 
 
 def parse_little_endian_signed_negative(buf):
-    ret = 0
-    for i, b in enumerate(buf):
-        ret += (b ^ 0xFF) * (1 << (i * 8))
-    ret += 1
-
-    ret *= -1
-    return ret
+    # buf holds a negative two's complement number
+    return int.from_bytes(buf, 'little') - (1 << (len(buf) * 8))
 
 
-def parse_little_endian_signed(buf, size=4):
-  
-  if not buf:
-      raise ValueError("Empty buffer")
+def parse_little_endian_signed(buf, size=None):
+    """Decode a little endian two's complement integer from the first size bytes of buf (all of it by default)"""
 
-  value = 0
-  for i in range(size):
-      value |= buf[i] << (i * 8)
+    if not buf:
+        raise ValueError("Empty buffer")
 
-  if value & (1 << ((size * 8) - 1)):
-      value = - (value + (1 << size * 8))
+    if size is not None:
+        buf = buf[:size]
 
-  return value
\ No newline at end of file
+    return int.from_bytes(buf, 'little', signed=True)
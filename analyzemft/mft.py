@@ -12,9 +12,7 @@
 #
 
 
-import binascii
 import json
-import ctypes
 import struct
 from optparse import OptionParser
 
@@ -22,7 +20,29 @@ from analyzemft import bitparse
 from analyzemft import mftutils
 
 
-def parse_record(raw_record, options):
+# Precompiled little endian structure decoders, used with unpack_from so no format parsing or slicing happens per field
+
+# FILE record header, up to and including the update sequence number
+MFT_HEADER = struct.Struct("<IHHQHHHHIIIxxHH2sI2s")
+
+# Attribute header fields common to resident and non-resident attributes
+ATR_HEADER = struct.Struct("<LLBBHHH")
+ATR_END_MARKER = b'\xff\xff\xff\xff'
+# Remainder of the attribute header: resident form, and non-resident form up to the data runs
+ATR_RESIDENT = struct.Struct("<LHB")
+ATR_NONRESIDENT = struct.Struct("<QQHH4xL4xL4xL")
+# Fixed parts of the attribute contents. File references are 6 byte record numbers plus a 2 byte sequence
+# number, read as the low 32 and high 16 bits of the record number and the sequence number.
+SI_ATTRIBUTE = struct.Struct("<8L6L2Q")
+FN_ATTRIBUTE = struct.Struct("<LHH8LqqQ2B")
+AL_ATTRIBUTE = struct.Struct("<LHBBQLHHH")
+VOLINFO_ATTRIBUTE = struct.Struct("<QBBHL")
+
+
+def parse_record(raw_record, options, handlers=None):
+    """Parse one MFT record. raw_record may be bytes or any buffer, e.g. a memoryview into a larger read.
+    handlers limits the attributes that are decoded (see FILEPATH_HANDLERS); by default all known ones are"""
+
     record = {
         'filename': '',
         'notes': '',
@@ -32,11 +52,6 @@ def parse_record(raw_record, options):
 
     decode_mft_header(record, raw_record)
 
-    # HACK: Apply the NTFS fixup on a 1024 byte record.
-    # Note that the fixup is only applied locally to this function.
-    if record['seq_number'] == raw_record[510:512] and record['seq_number'] == raw_record[1022:1024]:
-        raw_record = raw_record[:510] + record['seq_attr1'] + raw_record[512:1022] + record['seq_attr2']
-
     record_number = record['recordnum']
 
     if options.debug:
@@ -44,7 +59,7 @@ def parse_record(raw_record, options):
             record_number,
             record['magic'],
             record['attr_off'],
-            hex(int(record['flags'])),
+            hex(record['flags']),
             record['size'],
         ))
 
@@ -60,162 +75,76 @@ def parse_record(raw_record, options):
         record['corrupt'] = True
         return record
 
+    # HACK: Apply the NTFS fixup, gated on the first two sectors as for a 1024 byte record.
+    # Note that the fixup is only applied locally to this function, and only to records that will be walked;
+    # BAAD and corrupt records return above with just their header, which the fixup never touches.
+    # The update sequence array holds the sequence number and then the original last two bytes of each 512 byte
+    # sector, in sector order; larger (e.g. 4096 byte) records simply have more entries. It is only trusted when
+    # it lies between the header and the first attribute, so every entry is a full two bytes and replacing a
+    # sector end can never resize the buffer.
+    upd_off = record['upd_off']
+    upd_cnt = record['upd_cnt']
+    if (upd_cnt > 1 and upd_off + upd_cnt * 2 <= min(record['attr_off'], len(raw_record))
+            and record['seq_number'] == raw_record[510:512] and record['seq_number'] == raw_record[1022:1024]):
+        raw_record = bytearray(raw_record)
+
+        entry = upd_off + 2
+        for sector in range(min(upd_cnt - 1, len(raw_record) // 512)):
+            sector_end = sector * 512 + 510
+            if raw_record[sector_end:sector_end + 2] == record['seq_number']:
+                raw_record[sector_end:sector_end + 2] = raw_record[entry:entry + 2]
+            entry += 2
+
     read_ptr = record['attr_off']
 
+    # Walk the attributes through a memoryview so that the per-attribute slices don't copy the record.
+    # Anything stored in the record dict is copied out to bytes, as the caller may reuse the buffer.
+    raw_view = memoryview(raw_record)
+    buffer_end = record_end = len(raw_view)
+    # Nothing past the bytes in use can be an attribute, so stop there rather than at the end of the buffer.
+    # A size that doesn't even cover the first attribute header is garbage, so it is ignored.
+    if read_ptr + ATR_HEADER.size <= record['size'] < record_end:
+        record_end = record['size']
+    debug = options.debug
+    get_handler = (ATR_HANDLERS if handlers is None else handlers).get
+
     # How should we preserve the multiple attributes? Do we need to preserve them all?
-    while read_ptr < 1024:
+    while True:
 
-        atr_record = decode_atr_header(raw_record[read_ptr:])
+        # Past here only the end marker still fits, and an attribute header would run off the end of the record
+        if read_ptr + ATR_HEADER.size > record_end:
+            if raw_view[read_ptr:read_ptr + 4] == ATR_END_MARKER:
+                break
+            # No end marker where the size field says the record ends, so the size is wrong.
+            # Don't let it hide attributes: walk on to the end of the buffer.
+            if record_end < buffer_end:
+                record_end = buffer_end
+                continue
+            break
+
+        atr_record = decode_atr_header(raw_view, read_ptr)
         if atr_record['type'] == 0xffffffff:  # End of attributes
             break
 
         if atr_record['nlen'] > 0:
-            record_bytes = raw_record[
-                read_ptr + atr_record['name_off']: read_ptr + atr_record['name_off'] + atr_record['nlen'] * 2]
-            atr_record['name'] = record_bytes.decode('utf-16').encode('utf-8')
+            name_off = read_ptr + atr_record['name_off']
+            atr_record['name'] = str(raw_view[name_off:name_off + atr_record['nlen'] * 2], 'utf-16-le').encode('utf-8')
         else:
             atr_record['name'] = ''
 
-        if options.debug:
+        if debug:
             print("Attribute type: %x Length: %d Res: %x" % (atr_record['type'], atr_record['len'], atr_record['res']))
 
-        if atr_record['type'] == 0x10:  # Standard Information
-            if options.debug:
-                print("Stardard Information:\n++Type: %s Length: %d Resident: %s Name Len:%d Name Offset: %d" % (
-                    hex(int(atr_record['type'])),
-                    atr_record['len'],
-                    atr_record['res'],
-                    atr_record['nlen'],
-                    atr_record['name_off'],
-                ))
-            si_record = decode_si_attribute(raw_record[read_ptr + atr_record['soff']:], options.localtz)
-            record['si'] = si_record
-            if options.debug:
-                print("++CRTime: %s\n++MTime: %s\n++ATime: %s\n++EntryTime: %s" % (
-                    si_record['crtime'].dtstr,
-                    si_record['mtime'].dtstr,
-                    si_record['atime'].dtstr,
-                    si_record['ctime'].dtstr,
-                ))
-
-        elif atr_record['type'] == 0x20:  # Attribute list
-            if options.debug:
-                print("Attribute list")
-            if atr_record['res'] == 0:
-                al_record = decode_attribute_list(raw_record[read_ptr + atr_record['soff']:], record)
-                record['al'] = al_record
-                if options.debug:
-                    print("Name: %s" % (al_record['name']))
-            else:
-                if options.debug:
-                    print("Non-resident Attribute List?")
-                record['al'] = None
-
-        elif atr_record['type'] == 0x30:  # File name
-            if options.debug:
-                print("File name record")
-            fn_record = decode_fn_attribute(raw_record[read_ptr + atr_record['soff']:], options.localtz, record)
-            record['fn', record['fncnt']] = fn_record
-            if options.debug:
-                print("Name: %s (%d)" % (fn_record['name'], record['fncnt']))
-            record['fncnt'] += 1
-            if fn_record['crtime'] != 0:
-                if options.debug:
-                    print("\tCRTime: %s MTime: %s ATime: %s EntryTime: %s" % (
-                        fn_record['crtime'].dtstr,
-                        fn_record['mtime'].dtstr,
-                        fn_record['atime'].dtstr,
-                        fn_record['ctime'].dtstr,
-                    ))
-
-        elif atr_record['type'] == 0x40:  # Object ID
-            object_id_record = decode_object_id(raw_record[read_ptr + atr_record['soff']:])
-            record['objid'] = object_id_record
-            if options.debug:
-                print("Object ID")
-
-        elif atr_record['type'] == 0x50:  # Security descriptor
-            record['sd'] = True
-            if options.debug:
-                print("Security descriptor")
-
-        elif atr_record['type'] == 0x60:  # Volume name
-            record['volname'] = True
-            if options.debug:
-                print("Volume name")
-
-        elif atr_record['type'] == 0x70:  # Volume information
-            if options.debug:
-                print("Volume info attribute")
-            volume_info_record = decode_volume_info(raw_record[read_ptr + atr_record['soff']:], options)
-            record['volinfo'] = volume_info_record
-
-        elif atr_record['type'] == 0x80:  # Data
-            if atr_record['name'] != '':
-                record['data_name', record['ads']] = atr_record['name']
-                record['ads'] += 1
-            if atr_record['res'] == 0:
-                data_attribute = decode_data_attribute(raw_record[read_ptr + atr_record['soff']:], atr_record)
-            else:
-                data_attribute = {
-                    'ndataruns': atr_record['ndataruns'],
-                    'dataruns': atr_record['dataruns'],
-                    'drunerror': atr_record['drunerror'],
-                }
-            record['data', record['datacnt']] = data_attribute
-            record['datacnt'] += 1
-
-            if options.debug:
-                print("Data attribute")
-
-        elif atr_record['type'] == 0x90:  # Index root
-            record['indexroot'] = True
-            if options.debug:
-                print("Index root")
-
-        elif atr_record['type'] == 0xA0:  # Index allocation
-            record['indexallocation'] = True
-            if options.debug:
-                print("Index allocation")
-
-        elif atr_record['type'] == 0xB0:  # Bitmap
-            record['bitmap'] = True
-            if options.debug:
-                print("Bitmap")
-
-        elif atr_record['type'] == 0xC0:  # Reparse point
-            record['reparsepoint'] = True
-            if options.debug:
-                print("Reparse point")
-
-        elif atr_record['type'] == 0xD0:  # EA Information
-            record['eainfo'] = True
-            if options.debug:
-                print("EA Information")
-
-        elif atr_record['type'] == 0xE0:  # EA
-            record['ea'] = True
-            if options.debug:
-                print("EA")
-
-        elif atr_record['type'] == 0xF0:  # Property set
-            record['propertyset'] = True
-            if options.debug:
-                print("Property set")
-
-        elif atr_record['type'] == 0x100:  # Logged utility stream
-            record['loggedutility'] = True
-            if options.debug:
-                print("Logged utility stream")
-
-        else:
-            if options.debug:
-                print("Found an unknown attribute")
+        handler = get_handler(atr_record['type'])
+        if handler is not None:
+            handler(record, atr_record, raw_view, read_ptr, options)
+        elif debug:
+            print("Found an unknown attribute")
 
         if atr_record['len'] > 0:
             read_ptr = read_ptr + atr_record['len']
         else:
-            if options.debug:
+            if debug:
                 print("ATRrecord->len < 0, exiting loop")
             break
 
@@ -225,6 +154,152 @@ def parse_record(raw_record, options):
     return record
 
 
+# Attribute handlers, dispatched on the attribute type by parse_record through ATR_HANDLERS.
+# Each one is given the attribute header, the record view and the offset of the attribute in it.
+# The decoders take the view and an absolute offset, so no intermediate slices are made.
+
+def handle_si(record, atr_record, raw_view, read_ptr, options):  # Standard Information
+    debug = options.debug
+    if debug:
+        print("Stardard Information:\n++Type: %s Length: %d Resident: %s Name Len:%d Name Offset: %d" % (
+            hex(atr_record['type']),
+            atr_record['len'],
+            atr_record['res'],
+            atr_record['nlen'],
+            atr_record['name_off'],
+        ))
+    si_record = decode_si_attribute(raw_view, options.localtz, read_ptr + atr_record['soff'])
+    record['si'] = si_record
+    if debug:
+        print("++CRTime: %s\n++MTime: %s\n++ATime: %s\n++EntryTime: %s" % (
+            si_record['crtime'].dtstr,
+            si_record['mtime'].dtstr,
+            si_record['atime'].dtstr,
+            si_record['ctime'].dtstr,
+        ))
+
+
+def handle_al(record, atr_record, raw_view, read_ptr, options):  # Attribute list
+    if options.debug:
+        print("Attribute list")
+    if atr_record['res'] == 0:
+        al_record = decode_attribute_list(raw_view, record, read_ptr + atr_record['soff'])
+        record['al'] = al_record
+        if options.debug:
+            print("Name: %s" % (al_record['name']))
+    else:
+        if options.debug:
+            print("Non-resident Attribute List?")
+        record['al'] = None
+
+
+def handle_fn(record, atr_record, raw_view, read_ptr, options):  # File name
+    debug = options.debug
+    if debug:
+        print("File name record")
+    fn_record = decode_fn_attribute(raw_view, options.localtz, record, read_ptr + atr_record['soff'])
+    record['fn', record['fncnt']] = fn_record
+    if debug:
+        print("Name: %s (%d)" % (fn_record['name'], record['fncnt']))
+    if fn_record['nspace'] == 0x1 or fn_record['nspace'] == 0x3:  # Win32 or Win32 & DOS name
+        record['fnwin32'] = record['fncnt']
+    record['fncnt'] += 1
+    if debug and fn_record['crtime'] != 0:
+        print("\tCRTime: %s MTime: %s ATime: %s EntryTime: %s" % (
+            fn_record['crtime'].dtstr,
+            fn_record['mtime'].dtstr,
+            fn_record['atime'].dtstr,
+            fn_record['ctime'].dtstr,
+        ))
+
+
+def handle_objid(record, atr_record, raw_view, read_ptr, options):  # Object ID
+    object_id_record = decode_object_id(raw_view, read_ptr + atr_record['soff'])
+    record['objid'] = object_id_record
+    if options.debug:
+        print("Object ID")
+
+
+def handle_volinfo(record, atr_record, raw_view, read_ptr, options):  # Volume information
+    if options.debug:
+        print("Volume info attribute")
+    volume_info_record = decode_volume_info(raw_view, options, read_ptr + atr_record['soff'])
+    record['volinfo'] = volume_info_record
+
+
+def handle_data(record, atr_record, raw_view, read_ptr, options):  # Data
+    if atr_record['name'] != '':
+        record['data_name', record['ads']] = atr_record['name']
+        record['ads'] += 1
+    if atr_record['res'] == 0:
+        data_attribute = decode_data_attribute(raw_view, atr_record, read_ptr + atr_record['soff'])
+    else:
+        data_attribute = {
+            'ndataruns': atr_record['ndataruns'],
+            'dataruns': atr_record['dataruns'],
+            'drunerror': atr_record['drunerror'],
+        }
+    record['data', record['datacnt']] = data_attribute
+    record['datacnt'] += 1
+
+    if options.debug:
+        print("Data attribute")
+
+
+# Attributes whose presence is all that gets recorded: type -> (record key, debug description)
+FLAG_ATTRIBUTES = {
+    0x50: ('sd', "Security descriptor"),
+    0x60: ('volname', "Volume name"),
+    0x90: ('indexroot', "Index root"),
+    0xA0: ('indexallocation', "Index allocation"),
+    0xB0: ('bitmap', "Bitmap"),
+    0xC0: ('reparsepoint', "Reparse point"),
+    0xD0: ('eainfo', "EA Information"),
+    0xE0: ('ea', "EA"),
+    0xF0: ('propertyset', "Property set"),
+    0x100: ('loggedutility', "Logged utility stream"),
+}
+
+
+def handle_flag(record, atr_record, raw_view, read_ptr, options):
+    (key, description) = FLAG_ATTRIBUTES[atr_record['type']]
+    record[key] = True
+    if options.debug:
+        print(description)
+
+
+ATR_HANDLERS = {
+    0x10: handle_si,
+    0x20: handle_al,
+    0x30: handle_fn,
+    0x40: handle_objid,
+    0x70: handle_volinfo,
+    0x80: handle_data,
+}
+ATR_HANDLERS.update(dict.fromkeys(FLAG_ATTRIBUTES, handle_flag))
+
+# Reduced tables for passes that only use part of each record; the other attributes are skipped undecoded.
+# Building the filepaths needs nothing but the file names.
+FILEPATH_HANDLERS = {
+    0x30: handle_fn,
+}
+# The body file and L2T CSV only use the timestamps, plus the $DATA names for the alternate data streams.
+TIMELINE_HANDLERS = {
+    0x10: handle_si,
+    0x30: handle_fn,
+    0x80: handle_data,
+}
+
+
+# Empty columns for records without an object ID, and for the FN columns not filled, indexed by the FN count
+CSV_OBJID_PADDING = ('',) * 4
+CSV_FN_PADDING = (('',) * 15, ('',) * 15, ('',) * 10, ('',) * 5, ())
+# Record keys behind the attribute presence columns of the CSV, either side of the Filename column
+CSV_PRESENCE_BEFORE_FN = ('si', 'al')
+CSV_PRESENCE_AFTER_FN = ('objid', 'volname', 'volinfo', 'data', 'indexroot', 'indexallocation', 'bitmap',
+                         'reparse', 'eainfo', 'ea', 'propertyset', 'loggedutility')
+
+
 def mft_to_csv(record, ret_header, options):
     """Return a MFT record in CSV format"""
 
@@ -260,15 +335,11 @@ def mft_to_csv(record, ret_header, options):
         csv_string.extend(tmp_string)
         return csv_string
 
-    # tmp_string = ["%d" % record['lsn']]
-    #        csv_string.extend(tmp_string)
-    tmp_string = ["%d" % record['seq']]
-    csv_string.extend(tmp_string)
-
+    # csv_string.append("%d" % record['lsn'])
     if record['fncnt'] > 0:
-        csv_string.extend([str(record['fn', 0]['par_ref']), str(record['fn', 0]['par_seq'])])
+        csv_string.extend(["%d" % record['seq'], str(record['fn', 0]['par_ref']), str(record['fn', 0]['par_seq'])])
     else:
-        csv_string.extend(['NoParent', 'NoParent'])
+        csv_string.extend(["%d" % record['seq'], 'NoParent', 'NoParent'])
 
     if record['fncnt'] > 0 and 'si' in record:
         filename_buffer = [
@@ -309,7 +380,7 @@ def mft_to_csv(record, ret_header, options):
             record['objid']['orig_domid'],
         ]
     else:
-        objid_buffer = ['', '', '', '']
+        objid_buffer = CSV_OBJID_PADDING
 
     csv_string.extend(objid_buffer)
 
@@ -325,68 +396,27 @@ def mft_to_csv(record, ret_header, options):
         csv_string.extend(filename_buffer)
 
     # Pad out the remaining FN columns
-    if record['fncnt'] < 2:
-        tmp_string = ['', '', '', '', '', '', '', '', '', '', '', '', '', '', '']
-    elif record['fncnt'] == 2:
-        tmp_string = ['', '', '', '', '', '', '', '', '', '']
-    elif record['fncnt'] == 3:
-        tmp_string = ['', '', '', '', '']
-    else:
-        tmp_string = []
-
-    csv_string.extend(tmp_string)
-
-    for record_str in ['si', 'al']:
-        csv_string.append('True') if record_str in record else csv_string.append('False')
-
-    csv_string.append('True') if record['fncnt'] > 0 else csv_string.append('False')
-
-    for record_str in [
-        'objid',
-        'volname',
-        'volinfo',
-        'data',
-        'indexroot',
-        'indexallocation',
-        'bitmap',
-        'reparse',
-        'eainfo',
-        'ea',
-        'propertyset',
-        'loggedutility',
-    ]:
-        csv_string.append('True') if record_str in record else csv_string.append('False')
+    csv_string.extend(CSV_FN_PADDING[min(record['fncnt'], 4)])
+
+    csv_string.extend(['True' if key in record else 'False' for key in CSV_PRESENCE_BEFORE_FN])
+    csv_string.append('True' if record['fncnt'] > 0 else 'False')
+    csv_string.extend(['True' if key in record else 'False' for key in CSV_PRESENCE_AFTER_FN])
 
     if 'notes' in record:  # Log of abnormal activity related to this record
-        csv_string.append(record['notes'])
+        notes = record['notes']
     else:
-        csv_string.append('None')
+        notes = 'None'
         record['notes'] = ''
 
-    if 'stf-fn-shift' in record:
-        csv_string.append('Y')
-    else:
-        csv_string.append('N')
-
-    if 'usec-zero' in record:
-        csv_string.append('Y')
-    else:
-        csv_string.append('N')
-
-    if record['ads'] > 0:
-        csv_string.append('Y')
-    else:
-        csv_string.append('N')
-
-    if 'possible-copy' in record:
-        csv_string.append('Y')
-    else:
-        csv_string.append('N')
-
-    if 'possible-volmove' in record:
-        csv_string.append('Y')
-    else:
-        csv_string.append('N')
+    # The log and the anomaly flags close the row
+    csv_string.extend([
+        notes,
+        'Y' if 'stf-fn-shift' in record else 'N',
+        'Y' if 'usec-zero' in record else 'N',
+        'Y' if record['ads'] > 0 else 'N',
+        'Y' if 'possible-copy' in record else 'N',
+        'Y' if 'possible-volmove' in record else 'N',
+    ])
 
     return csv_string
 
@@ -420,37 +450,34 @@ def mft_to_body(record, full, std):
             name = record['fn', 0]['name']
 
         if std:  # Use STD_INFO
-            rec_bodyfile = ("%s|%s|%s|%s|%s|%s|%s|%d|%d|%d|%d\n" %
-                            ('0', name, '0', '0', '0', '0',
-                             int(record['fn', 0]['real_fsize']),
-                             int(record['si']['atime'].unixtime),  # was str ....
-                             int(record['si']['mtime'].unixtime),
-                             int(record['si']['ctime'].unixtime),
-                             int(record['si']['ctime'].unixtime)))
+            si = record['si']
+            rec_bodyfile = BODY_LINE % (name, record['fn', 0]['real_fsize'],
+                                        si['atime'].unixtime, si['mtime'].unixtime,
+                                        si['ctime'].unixtime, si['ctime'].unixtime)
         else:  # Use FN
-            rec_bodyfile = ("%s|%s|%s|%s|%s|%s|%s|%d|%d|%d|%d\n" %
-                            ('0', name, '0', '0', '0', '0',
-                             int(record['fn', 0]['real_fsize']),
-                             int(record['fn', 0]['atime'].unixtime),
-                             int(record['fn', 0]['mtime'].unixtime),
-                             int(record['fn', 0]['ctime'].unixtime),
-                             int(record['fn', 0]['crtime'].unixtime)))
+            fn = record['fn', 0]
+            rec_bodyfile = BODY_LINE % (name, fn['real_fsize'],
+                                        fn['atime'].unixtime, fn['mtime'].unixtime,
+                                        fn['ctime'].unixtime, fn['crtime'].unixtime)
 
     else:
         if 'si' in record:
-            rec_bodyfile = ("%s|%s|%s|%s|%s|%s|%s|%d|%d|%d|%d\n" %
-                            ('0', 'No FN Record', '0', '0', '0', '0', '0',
-                             int(record['si']['atime'].unixtime),  # was str ....
-                             int(record['si']['mtime'].unixtime),
-                             int(record['si']['ctime'].unixtime),
-                             int(record['si']['ctime'].unixtime)))
+            si = record['si']
+            rec_bodyfile = BODY_LINE % ('No FN Record', 0,
+                                        si['atime'].unixtime, si['mtime'].unixtime,
+                                        si['ctime'].unixtime, si['ctime'].unixtime)
         else:
-            rec_bodyfile = ("%s|%s|%s|%s|%s|%s|%s|%d|%d|%d|%d\n" %
-                            ('0', 'Corrupt Record', '0', '0', '0', '0', '0', 0, 0, 0, 0))
+            rec_bodyfile = BODY_CORRUPT_LINE
 
     return rec_bodyfile
 
 
+# Bodyfile lines: MD5|name|inode|mode|UID|GID|size|atime|mtime|ctime|crtime. MD5, inode, mode, UID and GID
+# are always 0, so they are part of the format. %d truncates the float timestamps just like int() did.
+BODY_LINE = "0|%s|0|0|0|0|%d|%d|%d|%d|%d\n"
+BODY_CORRUPT_LINE = BODY_LINE % ('Corrupt Record', 0, 0, 0, 0, 0)
+
+
 # l2t CSV output support
 # date,time,timezone,MACB,source,sourcetype,type,user,host,short,desc,version,filename,inode,notes,format,extra
 # http://code.google.com/p/log2timeline/wiki/l2t_csv
@@ -458,66 +485,28 @@ def mft_to_body(record, full, std):
 def mft_to_l2t(record):
     """ Return a MFT record in l2t CSV output format"""
 
-    csv_string = ''
+    # Only the creation time line is emitted
     if record['fncnt'] > 0:
-        for i in ('atime', 'mtime', 'ctime', 'crtime'):
-            (date, time) = record['fn', 0][i].dtstr.split(' ')
-
-            macb_str = '....'
-            type_str = '....'
-            if i == 'atime':
-                type_str = '$FN [.A..] time'
-                macb_str = '.A..'
-            if i == 'mtime':
-                type_str = '$FN [M...] time'
-                macb_str = 'M...'
-            if i == 'ctime':
-                type_str = '$FN [..C.] time'
-                macb_str = '..C.'
-            if i == 'crtime':
-                type_str = '$FN [...B] time'
-                macb_str = '...B'
-
-            csv_string = ("%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s\n" % (
-                date, time, 'TZ', macb_str, 'FILE', 'NTFS $MFT', type_str, 'user', 'host',
-                record['filename'],
-                'desc',
-                'version', record['filename'], record['seq'], record['notes'], 'format', 'extra'))
+        (date, time) = record['fn', 0]['crtime'].dtstr.split(' ')
+        csv_string = L2T_LINE % (date, time, '...B', '$FN [...B] time',
+                                 record['filename'], record['filename'], record['seq'], record['notes'])
 
     elif 'si' in record:
-        for i in ('atime', 'mtime', 'ctime', 'crtime'):
-            (date, time) = record['si'][i].dtstr.split(' ')
-
-            macb_str = '....'
-            type_str = '....'
-            if i == 'atime':
-                type_str = '$SI [.A..] time'
-                macb_str = '.A..'
-            if i == 'mtime':
-                type_str = '$SI [M...] time'
-                macb_str = 'M...'
-            if i == 'ctime':
-                type_str = '$SI [..C.] time'
-                macb_str = '..C.'
-            if i == 'crtime':
-                type_str = '$SI [...B] time'
-                macb_str = '...B'
-
-            csv_string = ("%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s\n" % (
-                date, time, 'TZ', macb_str, 'FILE', 'NTFS $MFT', type_str, 'user', 'host',
-                record['filename'],
-                'desc',
-                'version', record['filename'], record['seq'], record['notes'], 'format', 'extra'))
+        (date, time) = record['si']['crtime'].dtstr.split(' ')
+        csv_string = L2T_LINE % (date, time, '...B', '$SI [...B] time',
+                                 record['filename'], record['filename'], record['seq'], record['notes'])
 
     else:
-        csv_string = ("%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s|%s\n" % (
-            '-', '-', 'TZ', 'unknown time', 'FILE', 'NTFS $MFT', 'unknown time', 'user', 'host',
-            'Corrupt Record', 'desc',
-            'version', 'NoFNRecord', record['seq'], '-', 'format', 'extra'))
+        csv_string = L2T_LINE % ('-', '-', 'unknown time', 'unknown time',
+                                 'Corrupt Record', 'NoFNRecord', record['seq'], '-')
 
     return csv_string
 
 
+# date|time|timezone|MACB|source|sourcetype|type|user|host|short|desc|version|filename|inode|notes|format|extra
+L2T_LINE = "%s|%s|TZ|%s|FILE|NTFS $MFT|%s|user|host|%s|desc|version|%s|%s|%s|format|extra\n"
+
+
 def add_note(record, s):
     if record['notes'] == '':
         record['notes'] = "%s" % s
@@ -526,44 +515,38 @@ def add_note(record, s):
 
 
 def decode_mft_header(record, raw_record):
-    record['magic'] = struct.unpack("<I", raw_record[:4])[0]
-    record['upd_off'] = struct.unpack("<H", raw_record[4:6])[0]
-    record['upd_cnt'] = struct.unpack("<H", raw_record[6:8])[0]
-    record['lsn'] = struct.unpack("<d", raw_record[8:16])[0]
-    record['seq'] = struct.unpack("<H", raw_record[16:18])[0]
-    record['link'] = struct.unpack("<H", raw_record[18:20])[0]
-    record['attr_off'] = struct.unpack("<H", raw_record[20:22])[0]
-    record['flags'] = struct.unpack("<H", raw_record[22:24])[0]
-    record['size'] = struct.unpack("<I", raw_record[24:28])[0]
-    record['alloc_sizef'] = struct.unpack("<I", raw_record[28:32])[0]
-    record['base_ref'] = struct.unpack("<Lxx", raw_record[32:38])[0]
-    record['base_seq'] = struct.unpack("<H", raw_record[38:40])[0]
-    record['next_attrid'] = struct.unpack("<H", raw_record[40:42])[0]
-    record['f1'] = raw_record[42:44]  # Padding
-    record['recordnum'] = struct.unpack("<I", raw_record[44:48])[0]  # Number of this MFT Record
-    record['seq_number'] = raw_record[48:50]  # Sequence number
+    # The fixed part of the header is decoded in a single call, in the order of the fields on disk
+    (record['magic'], record['upd_off'], record['upd_cnt'], record['lsn'], record['seq'], record['link'],
+     record['attr_off'], record['flags'], record['size'], record['alloc_sizef'], record['base_ref'],
+     record['base_seq'], record['next_attrid'],
+     record['f1'],  # Padding
+     record['recordnum'],  # Number of this MFT Record
+     record['seq_number'],  # Sequence number
+     ) = MFT_HEADER.unpack_from(raw_record)
     # Sequence attributes location are hardcoded since the record size is hardcoded too.
     # The following two lines are subject to NTFS versions. See:
     # https://github.com/libyal/libfsntfs/blob/master/documentation/New%20Technologies%20File%20System%20(NTFS).asciidoc#mft-entry-header
     if record['upd_off'] == 42:
-        record['seq_attr1'] = raw_record[44:46]  # Sequence attribute for sector 1
-        record['seq_attr2'] = raw_record[46:58]  # Sequence attribute for sector 2
+        # Older (NTFS 3.0) headers have no record number, and the update sequence array starts where it would be
+        record['seq_number'] = bytes(raw_record[42:44])
+        record['seq_attr1'] = bytes(raw_record[44:46])  # Sequence attribute for sector 1
+        record['seq_attr2'] = bytes(raw_record[46:48])  # Sequence attribute for sector 2
     else:
-        record['seq_attr1'] = raw_record[50:52]  # Sequence attribute for sector 1
-        record['seq_attr2'] = raw_record[52:54]  # Sequence attribute for sector 2
+        record['seq_attr1'] = bytes(raw_record[50:52])  # Sequence attribute for sector 1
+        record['seq_attr2'] = bytes(raw_record[52:54])  # Sequence attribute for sector 2
     record['fncnt'] = 0  # Counter for number of FN attributes
     record['datacnt'] = 0  # Counter for number of $DATA attributes
 
 
+MFT_MAGIC_NAMES = {
+    0x454c4946: 'Good',
+    0x44414142: 'Bad',
+    0x00000000: 'Zero',
+}
+
+
 def decode_mft_magic(record):
-    if record['magic'] == 0x454c4946:
-        return "Good"
-    elif record['magic'] == 0x44414142:
-        return 'Bad'
-    elif record['magic'] == 0x00000000:
-        return 'Zero'
-    else:
-        return 'Unknown'
+    return MFT_MAGIC_NAMES.get(record['magic'], 'Unknown')
 
 
 # decodeMFTisactive and decodeMFTrecordtype both look at the flags field in the MFT header.
@@ -572,101 +555,81 @@ def decode_mft_magic(record):
 #
 # I had this coded incorrectly initially. Spencer Lynch identified and fixed the code. Many thanks!
 
+# Both are answered from tables: MFT_ACTIVE_NAMES is indexed by the first bit, MFT_RECORD_TYPES by the next three.
+
+MFT_ACTIVE_NAMES = ('Inactive', 'Active')
+MFT_RECORD_TYPES = (
+    'File',
+    'Folder',
+    'File + Unknown1',
+    'Folder + Unknown1',
+    'File + Unknown2',
+    'Folder + Unknown2',
+    'File + Unknown1 + Unknown2',
+    'Folder + Unknown1 + Unknown2',
+)
+
+
 def decode_mft_isactive(record):
-    if record['flags'] & 0x0001:
-        return 'Active'
-    else:
-        return 'Inactive'
+    return MFT_ACTIVE_NAMES[record['flags'] & 0x0001]
 
 
 def decode_mft_recordtype(record):
-    if int(record['flags']) & 0x0002:
-        tmp_buffer = 'Folder'
-    else:
-        tmp_buffer = 'File'
-    if int(record['flags']) & 0x0004:
-        tmp_buffer = "%s %s" % (tmp_buffer, '+ Unknown1')
-    if int(record['flags']) & 0x0008:
-        tmp_buffer = "%s %s" % (tmp_buffer, '+ Unknown2')
-
-    return tmp_buffer
+    return MFT_RECORD_TYPES[(record['flags'] >> 1) & 0x7]
 
 
-def decode_atr_header(s):
-    d = {'type': struct.unpack("<L", s[:4])[0]}
+def decode_atr_header(s, offset=0):
+    d = {}
+    (d['type'], d['len'], d['res'], d['nlen'], d['name_off'], d['flags'], d['id']) = ATR_HEADER.unpack_from(s, offset)
     if d['type'] == 0xffffffff:
-        return d
-    d['len'] = struct.unpack("<L", s[4:8])[0]
-    d['res'] = struct.unpack("B", s[8:9])[0]
-    d['nlen'] = struct.unpack("B", s[9:10])[0]
-    d['name_off'] = struct.unpack("<H", s[10:12])[0]
-    d['flags'] = struct.unpack("<H", s[12:14])[0]
-    d['id'] = struct.unpack("<H", s[14:16])[0]
+        return {'type': d['type']}
     if d['res'] == 0:
-        d['ssize'] = struct.unpack("<L", s[16:20])[0]  # dwLength
-        d['soff'] = struct.unpack("<H", s[20:22])[0]  # wAttrOffset
-        d['idxflag'] = struct.unpack("B", s[22:23])[0]  # uchIndexedTag
-        _ = struct.unpack("B", s[23:24])[0]  # Padding
+        # dwLength, wAttrOffset, uchIndexedTag
+        (d['ssize'], d['soff'], d['idxflag']) = ATR_RESIDENT.unpack_from(s, offset + 16)
     else:
-        # d['start_vcn'] = struct.unpack("<Lxxxx",s[16:24])[0]    # n64StartVCN
-        # d['last_vcn'] = struct.unpack("<Lxxxx",s[24:32])[0]     # n64EndVCN
-        d['start_vcn'] = struct.unpack("<Q", s[16:24])[0]  # n64StartVCN
-        d['last_vcn'] = struct.unpack("<Q", s[24:32])[0]  # n64EndVCN
-        d['run_off'] = struct.unpack("<H", s[32:34])[0]  # wDataRunOffset (in clusters, from start of partition?)
-        d['compsize'] = struct.unpack("<H", s[34:36])[0]  # wCompressionSize
-        _ = struct.unpack("<I", s[36:40])[0]  # Padding
-        d['allocsize'] = struct.unpack("<Lxxxx", s[40:48])[0]  # n64AllocSize
-        d['realsize'] = struct.unpack("<Lxxxx", s[48:56])[0]  # n64RealSize
-        d['streamsize'] = struct.unpack("<Lxxxx", s[56:64])[0]  # n64StreamSize
-        (d['ndataruns'], d['dataruns'], d['drunerror']) = unpack_dataruns(s[64:])
+        # n64StartVCN, n64EndVCN, wDataRunOffset (in clusters, from start of partition?), wCompressionSize,
+        # and the low 32 bits of n64AllocSize, n64RealSize and n64StreamSize
+        (d['start_vcn'], d['last_vcn'], d['run_off'], d['compsize'],
+         d['allocsize'], d['realsize'], d['streamsize']) = ATR_NONRESIDENT.unpack_from(s, offset + 16)
+        (d['ndataruns'], d['dataruns'], d['drunerror']) = unpack_dataruns(s, offset + 64)
 
     return d
 
 
 # Dataruns - http://inform.pucp.edu.pe/~inf232/Ntfs/ntfs_doc_v0.5/concepts/data_runs.html
-def unpack_dataruns(datarun_str):
+def unpack_dataruns(datarun_str, offset=0):
     dataruns = []
     numruns = 0
-    pos = 0
+    pos = offset
     prevoffset = 0
     error = ''
 
-    c_uint8 = ctypes.c_uint8
-
-    class LengthBits(ctypes.LittleEndianStructure):
-        _fields_ = [
-            ("lenlen", c_uint8, 4),
-            ("offlen", c_uint8, 4),
-        ]
-
-    class Lengths(ctypes.Union):
-        _fields_ = [("b", LengthBits),
-                    ("asbyte", c_uint8)]
-
-    lengths = Lengths()
-
     # mftutils.hexdump(str,':',16)
 
     while True:
-        lengths.asbyte = struct.unpack("B", datarun_str[pos:pos + 1])[0]
+        header = datarun_str[pos]  # Indexing a bytes-like object already gives an int
         pos += 1
-        if lengths.asbyte == 0x00:
+        if header == 0x00:
             break
 
-        if lengths.b.lenlen > 6 or lengths.b.lenlen == 0:
+        # The low nibble is the size of the run length field, the high nibble the size of the run offset field
+        lenlen = header & 0x0F
+        offlen = header >> 4
+
+        if lenlen > 6 or lenlen == 0:
             error = "Datarun oddity."
             break
 
-        bit_len = bitparse.parse_little_endian_signed(datarun_str[pos:pos + lengths.b.lenlen])
+        bit_len = bitparse.parse_little_endian_signed(datarun_str[pos:pos + lenlen])
 
-        # print lengths.b.lenlen, lengths.b.offlen, bit_len
-        pos += lengths.b.lenlen
+        # print lenlen, offlen, bit_len
+        pos += lenlen
 
-        if lengths.b.offlen > 0:
-            offset = bitparse.parse_little_endian_signed(datarun_str[pos:pos + lengths.b.offlen])
+        if offlen > 0:
+            offset = bitparse.parse_little_endian_signed(datarun_str[pos:pos + offlen])
             offset = offset + prevoffset
             prevoffset = offset
-            pos += lengths.b.offlen
+            pos += offlen
         else:  # Sparse
             offset = 0
             pos += 1
@@ -674,90 +637,91 @@ def unpack_dataruns(datarun_str):
         dataruns.append([bit_len, offset])
         numruns += 1
 
-        # print "Lenlen: %d Offlen: %d Len: %d Offset: %d" % (lengths.b.lenlen, lengths.b.offlen, bit_len, offset)
+        # print "Lenlen: %d Offlen: %d Len: %d Offset: %d" % (lenlen, offlen, bit_len, offset)
 
     return numruns, dataruns, error
 
 
-def decode_si_attribute(s, localtz):
+def decode_si_attribute(s, localtz, offset=0):
+    (crlo, crhi, mlo, mhi, clo, chi, alo, ahi,
+     dos, maxver, ver, class_id, own_id, sec_id, quota, usn) = SI_ATTRIBUTE.unpack_from(s, offset)
     d = {
-        'crtime': mftutils.WindowsTime(struct.unpack("<L", s[:4])[0], struct.unpack("<L", s[4:8])[0], localtz),
-        'mtime': mftutils.WindowsTime(struct.unpack("<L", s[8:12])[0], struct.unpack("<L", s[12:16])[0], localtz),
-        'ctime': mftutils.WindowsTime(struct.unpack("<L", s[16:20])[0], struct.unpack("<L", s[20:24])[0], localtz),
-        'atime': mftutils.WindowsTime(struct.unpack("<L", s[24:28])[0], struct.unpack("<L", s[28:32])[0], localtz),
-        'dos': struct.unpack("<I", s[32:36])[0], 'maxver': struct.unpack("<I", s[36:40])[0],
-        'ver': struct.unpack("<I", s[40:44])[0], 'class_id': struct.unpack("<I", s[44:48])[0],
-        'own_id': struct.unpack("<I", s[48:52])[0], 'sec_id': struct.unpack("<I", s[52:56])[0],
-        'quota': struct.unpack("<d", s[56:64])[0], 'usn': struct.unpack("<d", s[64:72])[0],
+        'crtime': mftutils.WindowsTime(crlo, crhi, localtz),
+        'mtime': mftutils.WindowsTime(mlo, mhi, localtz),
+        'ctime': mftutils.WindowsTime(clo, chi, localtz),
+        'atime': mftutils.WindowsTime(alo, ahi, localtz),
+        'dos': dos, 'maxver': maxver,
+        'ver': ver, 'class_id': class_id,
+        'own_id': own_id, 'sec_id': sec_id,
+        'quota': quota, 'usn': usn,
     }
 
     return d
 
 
-def decode_fn_attribute(s, localtz, _):
+def decode_fn_attribute(s, localtz, _, offset=0):
     # File name attributes can have null dates.
 
+    (par_ref, par_ref_high, par_seq, crlo, crhi, mlo, mhi, clo, chi, alo, ahi,
+     alloc_fsize, real_fsize, flags, nlen, nspace) = FN_ATTRIBUTE.unpack_from(s, offset)
     d = {
-        'par_ref': struct.unpack("<Lxx", s[:6])[0], 'par_seq': struct.unpack("<H", s[6:8])[0],
-        'crtime': mftutils.WindowsTime(struct.unpack("<L", s[8:12])[0], struct.unpack("<L", s[12:16])[0], localtz),
-        'mtime': mftutils.WindowsTime(struct.unpack("<L", s[16:20])[0], struct.unpack("<L", s[20:24])[0], localtz),
-        'ctime': mftutils.WindowsTime(struct.unpack("<L", s[24:28])[0], struct.unpack("<L", s[28:32])[0], localtz),
-        'atime': mftutils.WindowsTime(struct.unpack("<L", s[32:36])[0], struct.unpack("<L", s[36:40])[0], localtz),
-        'alloc_fsize': struct.unpack("<q", s[40:48])[0], 'real_fsize': struct.unpack("<q", s[48:56])[0],
-        'flags': struct.unpack("<d", s[56:64])[0], 'nlen': struct.unpack("B", s[64:65])[0],
-        'nspace': struct.unpack("B", s[65:66])[0],
+        'par_ref': par_ref | (par_ref_high << 32), 'par_seq': par_seq,
+        'crtime': mftutils.WindowsTime(crlo, crhi, localtz),
+        'mtime': mftutils.WindowsTime(mlo, mhi, localtz),
+        'ctime': mftutils.WindowsTime(clo, chi, localtz),
+        'atime': mftutils.WindowsTime(alo, ahi, localtz),
+        'alloc_fsize': alloc_fsize, 'real_fsize': real_fsize,
+        'flags': flags, 'nlen': nlen,
+        'nspace': nspace,
     }
 
-    attr_bytes = s[66:66 + d['nlen'] * 2]
+    # NTFS names are always little endian UTF-16 with no BOM, and str() decodes the view without copying it first
     try:
-        d['name'] = attr_bytes.decode('utf-16').encode('utf-8')
+        d['name'] = str(s[offset + 66:offset + 66 + nlen * 2], 'utf-16-le').encode('utf-8')
     except:
         d['name'] = 'UnableToDecodeFilename'
 
     return d
 
 
-def decode_attribute_list(s, _):
+def decode_attribute_list(s, _, offset=0):
+    (atype, alen, nlen, f1, start_vcn, file_ref, file_ref_high, seq, aid) = AL_ATTRIBUTE.unpack_from(s, offset)
     d = {
-        'type': struct.unpack("<I", s[:4])[0], 'len': struct.unpack("<H", s[4:6])[0],
-        'nlen': struct.unpack("B", s[6:7])[0], 'f1': struct.unpack("B", s[7:8])[0],
-        'start_vcn': struct.unpack("<d", s[8:16])[0], 'file_ref': struct.unpack("<Lxx", s[16:22])[0],
-        'seq': struct.unpack("<H", s[22:24])[0], 'id': struct.unpack("<H", s[24:26])[0],
+        'type': atype, 'len': alen, 'nlen': nlen, 'f1': f1,
+        'start_vcn': start_vcn, 'file_ref': file_ref | (file_ref_high << 32), 'seq': seq, 'id': aid,
     }
 
-    attr_bytes = s[26:26 + d['nlen'] * 2]
-    d['name'] = attr_bytes.decode('utf-16').encode('utf-8')
+    d['name'] = str(s[offset + 26:offset + 26 + d['nlen'] * 2], 'utf-16-le').encode('utf-8')
 
     return d
 
 
-def decode_volume_info(s, options):
-    d = {
-        'f1': struct.unpack("<d", s[:8])[0], 'maj_ver': struct.unpack("B", s[8:9])[0],
-        'min_ver': struct.unpack("B", s[9:10])[0], 'flags': struct.unpack("<H", s[10:12])[0],
-        'f2': struct.unpack("<I", s[12:16])[0],
-    }
+def decode_volume_info(s, options, offset=0):
+    d = {}
+    (d['f1'], d['maj_ver'], d['min_ver'], d['flags'], d['f2']) = VOLINFO_ATTRIBUTE.unpack_from(s, offset)
 
     if options.debug:
-        print("+Volume Info")
-        print("++F1%d" % d['f1'])
-        print("++Major Version: %d" % d['maj_ver'])
-        print("++Minor Version: %d" % d['min_ver'])
-        print("++Flags: %d" % d['flags'])
-        print("++F2: %d" % d['f2'])
+        print("+Volume Info\n++F1%d\n++Major Version: %d\n++Minor Version: %d\n++Flags: %d\n++F2: %d" % (
+            d['f1'],
+            d['maj_ver'],
+            d['min_ver'],
+            d['flags'],
+            d['f2'],
+        ))
 
     return d
 
 
 # Decode a Resident Data Attribute
-def decode_data_attribute(s, at_rrecord):
-    d = {'data': s[:at_rrecord['ssize']]}
+def decode_data_attribute(s, at_rrecord, offset=0):
+    d = {'data': bytes(s[offset:offset + at_rrecord['ssize']])}
 
     #        print 'Data: ', d['data']
     return d
 
 
-def decode_object_id(s):
+def decode_object_id(s, offset=0):
+    s = bytes(s[offset:offset + 64])  # object_id() reverses slices, which needs contiguous bytes
     d = {
         'objid': object_id(s[0:16]),
         'orig_volid': object_id(s[16:32]),
@@ -769,11 +733,12 @@ def decode_object_id(s):
 
 
 def object_id(s):
-    if s == 0:
+    if not s:
         objstr = 'Undefined'
     else:
-        objstr = '-'.join(map(bytes.decode, list(map(binascii.hexlify, (s[0:4][::-1], s[4:6][::-1], \
-                                                                   s[6:8][::-1], s[8:10], s[10:])))))
+        # The first three GUID fields are stored little endian, so put them in display order and hex it all at once
+        h = (s[3::-1] + s[5:3:-1] + s[7:5:-1] + s[8:]).hex()
+        objstr = '%s-%s-%s-%s-%s' % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:])
 
     return objstr
 
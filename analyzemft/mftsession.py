@@ -12,9 +12,14 @@
 VERSION = "v3.0.1"
 
 import csv
+import io
 import json
+import mmap
 import os
 import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 from optparse import OptionParser
 
 from analyzemft import mft
@@ -23,6 +28,22 @@ from analyzemft import mft
 SIAttributeSizeXP = 72
 SIAttributeSizeNT = 48
 
+# Parent reference stored for records without a file name attribute
+NoParentRef = -1
+
+# Record sizes we trust when reading them from the header of the first record. 1024 is the default.
+RecordSizes = (1024, 4096)
+
+# Number of records read at a time when the MFT can't be memory-mapped
+ReadBlockRecords = 16384
+
+# Number of records handed to the worker pool at a time
+ParseBlockRecords = 16384
+
+# Output files are written through large buffers, and rows are handed to the writers a block of records at a time
+OutputBufferSize = 1 << 20
+OutputBlockRows = 4096
+
 
 class MftSession:
     """Class to describe an entire MFT processing session"""
@@ -37,16 +58,26 @@ class MftSession:
 
 
     def __init__(self):
-        self.mft = {}
+        # Per-record columns used to build the filepaths, indexed by record number.
+        # Records without a file name attribute have a par_ref of NoParentRef and a name of None.
+        # par_ref is a typed array, so it costs 8 bytes a record rather than a pointer to an int object.
+        self.mft_filename = []
+        self.mft_par_ref = array('q')
+        self.mft_name = []
         self.fullmft = {}
         self.folders = {}
         self.debug = False
         self.mftsize = 0
+        self.mft_map = None
+        self.record_size = 1024
+        self.csv_rows = []
+        self.l2t_lines = []
+        self.body_lines = []
 
     def mft_options(self):
 
         parser = OptionParser()
-        parser.set_defaults(inmemory=False, debug=False, UseLocalTimezone=False, UseGUI=False)
+        parser.set_defaults(inmemory=False, debug=False, UseLocalTimezone=False, UseGUI=False, workers=1)
 
         parser.add_option("-v", "--version", action="store_true", dest="version",
                           help="report version and exit")
@@ -100,6 +131,9 @@ class MftSession:
         parser.add_option("-w", "--windows-path",
                           action="store_true", dest="winpath",
                           help="File paths should use the windows path separator instead of linux")
+
+        parser.add_option("-t", "--workers", type="int", dest="workers",
+                          help="parse records in N worker processes", metavar="N")
         
         
         (self.options, args) = parser.parse_args()
@@ -126,29 +160,58 @@ class MftSession:
         #     print "-o <filename> or -b <filename> or -c <filename> required."
         #     sys.exit()
 
+        # O_NOATIME spares the inode update, and leaves the access time of the evidence alone. The kernel only
+        # allows it for the owner of the file, so open without it when it is refused.
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
         try:
-            self.file_mft = open(self.options.filename, 'rb')
-        except:
-            print("Unable to open file: %s" % self.options.filename)
+            try:
+                fd = os.open(self.options.filename, flags | getattr(os, 'O_NOATIME', 0))
+            except PermissionError:
+                fd = os.open(self.options.filename, flags)
+            try:
+                self.file_mft = os.fdopen(fd, 'rb')  # Refuses directories, which os.open accepts
+            except OSError:
+                os.close(fd)
+                raise
+        except OSError as e:
+            print("Unable to open file: %s (%s)" % (self.options.filename, e.strerror))
             sys.exit()
 
+        # Both passes read the MFT front to back, so ask for aggressive readahead.
+        # It is only a hint, and pipes refuse it (ESPIPE), so a failure is ignored.
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+        # Map the MFT so records are sliced straight out of the page cache rather than read() one at a time
+        try:
+            self.mft_map = mmap.mmap(self.file_mft.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self.mft_map.madvise(mmap.MADV_SEQUENTIAL)
+        except (ValueError, OSError):  # Empty files, pipes and some devices can't be mapped
+            self.mft_map = None
+
+        self.record_size = self.detect_record_size()
+
         if self.options.output is not None:
             try:
-                self.file_csv = csv.writer(open(self.options.output, 'w'), dialect=csv.excel, quoting=1)
+                self.file_csv = csv.writer(open(self.options.output, 'w', buffering=OutputBufferSize, newline=''), dialect=csv.excel, quoting=1)
             except (IOError, TypeError):
                 print("Unable to open file: %s" % self.options.output)
                 sys.exit()
         
         if self.options.bodyfile is not None:
             try:
-                self.file_body = open(self.options.bodyfile, 'w')
+                self.file_body = open(self.options.bodyfile, 'w', buffering=OutputBufferSize)
             except:
                 print("Unable to open file: %s" % self.options.bodyfile)
                 sys.exit()
 
         if self.options.csvtimefile is not None:
             try:
-                self.file_csv_time = open(self.options.csvtimefile, 'w')
+                self.file_csv_time = open(self.options.csvtimefile, 'w', buffering=OutputBufferSize)
             except (IOError, TypeError):
                 print("Unable to open file: %s" % self.options.csvtimefile)
                 sys.exit()
@@ -157,8 +220,8 @@ class MftSession:
     # Not foolproof by any means, but could stop you from wasting time on a doomed to failure run.
     def sizecheck(self):
 
-        # The number of records in the MFT is the size of the MFT / 1024
-        self.mftsize = int(os.path.getsize(self.options.filename)) / 1024
+        # The number of records in the MFT is the size of the MFT / the record size
+        self.mftsize = int(os.path.getsize(self.options.filename)) // self.record_size
 
         if self.options.debug:
             print('There are %d records in the MFT' % self.mftsize)
@@ -174,34 +237,103 @@ class MftSession:
             print('Need %d bytes of memory to save into memory' % sizeinbytes)
 
         try:
-            arr = []
-            for i in range(0, sizeinbytes / 10):
-                arr.append(1)
+            arr = [1] * (sizeinbytes // 10)
+            del arr
 
         except MemoryError:
             print('Error: Not enough memory to store MFT in memory. Try running again without -s option')
             sys.exit()
 
+    def detect_record_size(self):
+        """Return the MFT record size, as given by the allocated size in the header of record 0 ($MFT)"""
+
+        self.file_mft.seek(0)
+        raw_record = self.file_mft.read(1024)
+
+        record = {}
+        if len(raw_record) == 1024:
+            mft.decode_mft_header(record, raw_record)
+        if record.get('magic') == 0x454c4946 and record['alloc_sizef'] in RecordSizes:
+            record_size = record['alloc_sizef']
+        else:
+            record_size = 1024
+
+        if self.options.debug:
+            print('MFT record size is %d bytes' % record_size)
+
+        return record_size
+
+    def read_records(self):
+        record_size = self.record_size
+
+        if self.mft_map is not None:
+            # Zero-copy views; parse_record copies out whatever it keeps
+            mft_view = memoryview(self.mft_map)
+            for offset in range(0, len(mft_view), record_size):
+                yield mft_view[offset:offset + record_size]
+            return
+
+        # reset the file reading
+        self.file_mft.seek(0)
+
+        # Read many records per call and hand out views of the block. A buffered read() only comes up
+        # short at the end of the file, so blocks stay aligned on record boundaries.
+        block = self.file_mft.read(record_size * ReadBlockRecords)
+        while block != b"":
+            block_view = memoryview(block)
+            for offset in range(0, len(block_view), record_size):
+                yield block_view[offset:offset + record_size]
+            block = self.file_mft.read(record_size * ReadBlockRecords)
+
+    def parse_records(self, handlers=None):
+        """Yield the parsed records of the MFT in file order, decoding only the attributes in handlers if given"""
+
+        # Callers that build their own options (the plaso path) may not have the -t setting at all
+        workers = getattr(self.options, 'workers', 1)
+
+        if workers <= 1:
+            for raw_record in self.read_records():
+                yield mft.parse_record(raw_record, self.options, handlers)
+            return
+
+        # Parsing is CPU bound and records are independent until the filepaths are built, so spread it
+        # over worker processes. The pool is fed a block at a time so a large MFT is never queued whole.
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            raw_records = map(bytes, self.read_records())  # Views of the map can't be pickled
+            block = list(islice(raw_records, ParseBlockRecords))
+            while block:
+                chunksize = max(1, len(block) // (workers * 4))
+                yield from executor.map(mft.parse_record, block, repeat(self.options, len(block)),
+                                        repeat(handlers, len(block)), chunksize=chunksize)
+                block = list(islice(raw_records, ParseBlockRecords))
+
     def process_mft_file(self):
 
         self.sizecheck()
 
         self.build_filepaths()
 
-        # reset the file reading
         self.num_records = 0
-        self.file_mft.seek(0)
-        raw_record = self.file_mft.read(1024)
 
         if self.options.output is not None:
             self.file_csv.writerow(mft.mft_to_csv(None, True, self.options))
 
-        while raw_record != b"":
-            record = mft.parse_record(raw_record, self.options)
-            if self.options.debug:
+        # When only the timeline outputs are wanted, don't decode the attributes none of them use
+        handlers = None
+        if (self.options.output is None and self.options.json is None and not self.options.inmemory
+                and not self.options.debug):
+            handlers = mft.TIMELINE_HANDLERS
+
+        self.resolve_outputs()
+
+        debug = self.options.debug
+        filenames = self.mft_filename
+
+        for record in self.parse_records(handlers):
+            if debug:
                 print(record)
 
-            record['filename'] = self.mft[self.num_records]['filename']
+            record['filename'] = filenames[self.num_records]
 
             self.do_output(record)
 
@@ -214,151 +346,228 @@ class MftSession:
                     record_ads['filename'] = record['filename'] + ':' + record['data_name', i].decode()
                     self.do_output(record_ads)
 
-            raw_record = self.file_mft.read(1024)
+        self.flush_output()
+
+        self.release_mft_cache()
+
+    def resolve_outputs(self):
+        """Note which outputs are wanted, so do_output doesn't look each one up in the options for every record"""
+        self.output_inmemory = self.options.inmemory
+        self.output_csv = self.options.output is not None
+        self.output_json = self.options.json
+        self.output_l2t = self.options.csvtimefile is not None
+        self.output_body = self.options.bodyfile is not None
+        self.output_progress = self.options.progress
 
     def do_output(self, record):
-        
-        
-        if self.options.inmemory:
+
+        if self.output_inmemory:
             self.fullmft[self.num_records] = record
 
-        if self.options.output is not None:
-            self.file_csv.writerow(mft.mft_to_csv(record, False, self.options))
-        
-        if self.options.json is not None:    
-            with open(self.options.json, 'a') as outfile:
+        if self.output_csv:
+            self.csv_rows.append(mft.mft_to_csv(record, False, self.options))
+
+        if self.output_json is not None:
+            with open(self.output_json, 'a') as outfile:
                 json.dump(mft.mft_to_json(record), outfile)
                 outfile.write('\n')
-            
-        
- 
-    
-            
-        if self.options.csvtimefile is not None:
-            self.file_csv_time.write(mft.mft_to_l2t(record))
 
-        if self.options.bodyfile is not None:
-            self.file_body.write(mft.mft_to_body(record, self.options.bodyfull, self.options.bodystd))
+        if self.output_l2t:
+            self.l2t_lines.append(mft.mft_to_l2t(record))
+
+        if self.output_body:
+            self.body_lines.append(mft.mft_to_body(record, self.options.bodyfull, self.options.bodystd))
+
+        if max(len(self.csv_rows), len(self.l2t_lines), len(self.body_lines)) >= OutputBlockRows:
+            self.flush_output()
 
-        if self.options.progress:
+        if self.output_progress:
             if self.num_records % (self.mftsize / 5) == 0 and self.num_records > 0:
                 print('Building MFT: {0:.0f}'.format(100.0 * self.num_records / self.mftsize) + '%')
 
+    def flush_output(self):
+        """Write out the rows and lines queued by do_output"""
+        if self.csv_rows:
+            self.file_csv.writerows(self.csv_rows)
+            self.csv_rows.clear()
+        if self.l2t_lines:
+            self.file_csv_time.writelines(self.l2t_lines)
+            self.l2t_lines.clear()
+        if self.body_lines:
+            self.file_body.writelines(self.body_lines)
+            self.body_lines.clear()
+
+    def release_mft_cache(self):
+        """Let the kernel drop the MFT's pages once we are done with them, rather than other cached data"""
+        if self.mft_map is not None and hasattr(mmap, 'MADV_DONTNEED'):
+            self.mft_map.madvise(mmap.MADV_DONTNEED)  # The pages are clean, so this only unmaps them
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(self.file_mft.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+
     def plaso_process_mft_file(self):
 
         # TODO - Add ADS support ....
 
         self.build_filepaths()
 
-        # reset the file reading
         self.num_records = 0
-        self.file_mft.seek(0)
-        raw_record = self.file_mft.read(1024)
 
-        while raw_record != b"":
-            record = mft.parse_record(raw_record, self.options)
-            if self.options.debug:
+        debug = self.options.debug
+        filenames = self.mft_filename
+        fullmft = self.fullmft
+
+        for record in self.parse_records():
+            if debug:
                 print(record)
 
-            record['filename'] = self.mft[self.num_records]['filename']
+            record['filename'] = filenames[self.num_records]
 
-            self.fullmft[self.num_records] = record
+            fullmft[self.num_records] = record
 
             self.num_records += 1
 
-            raw_record = self.file_mft.read(1024)
-
     def build_filepaths(self):
-        # reset the file reading
-        self.file_mft.seek(0)
-
         self.num_records = 0
 
-        # 1024 is valid for current version of Windows but should really get this value from somewhere
-        raw_record = self.file_mft.read(1024)
-        while raw_record != b"":
-            minirec = {}
-            record = mft.parse_record(raw_record, self.options)
-            if self.options.debug:
+        # The number of records is known from the file size, so the columns are sized once up front.
+        # Inputs that report no size (devices, or file objects without a descriptor handed in by callers)
+        # fall back to growing them a record at a time.
+        if self.mft_map is not None:
+            count = -(-len(self.mft_map) // self.record_size)
+        else:
+            try:
+                count = -(-os.fstat(self.file_mft.fileno()).st_size // self.record_size)
+            except (OSError, io.UnsupportedOperation):
+                count = 0
+        self.mft_filename = [''] * count
+        self.mft_par_ref = array('q', [NoParentRef]) * count
+        self.mft_name = [None] * count
+
+        # Names repeat a lot across a volume (desktop.ini, per-user folders, ...), so keep one copy of each
+        intern_name = {}.setdefault
+
+        debug = self.options.debug
+        progress = self.options.progress
+
+        # Only the file names are used here. Debug output shows the whole record, so it still gets decoded in full.
+        handlers = None if debug else mft.FILEPATH_HANDLERS
+
+        for record in self.parse_records(handlers):
+            if debug:
                 print(record)
 
-            minirec['filename'] = record['filename']
-            minirec['fncnt'] = record['fncnt']
-            if record['fncnt'] == 1:
-                minirec['par_ref'] = record['fn', 0]['par_ref']
-                minirec['name'] = record['fn', 0]['name']
-            if record['fncnt'] > 1:
-                minirec['par_ref'] = record['fn', 0]['par_ref']
-                for i in (0, record['fncnt'] - 1):
-                    # print record['fn',i]
-                    if record['fn', i]['nspace'] == 0x1 or record['fn', i]['nspace'] == 0x3:
-                        minirec['name'] = record['fn', i]['name']
-                if minirec.get('name') is None:
-                    minirec['name'] = record['fn', record['fncnt'] - 1]['name']
-
-            self.mft[self.num_records] = minirec
-
-            if self.options.progress:
+            if self.num_records >= count:
+                self.mft_filename.append('')
+                self.mft_par_ref.append(NoParentRef)
+                self.mft_name.append(None)
+
+            if record['fncnt'] > 0:
+                self.mft_par_ref[self.num_records] = record['fn', 0]['par_ref']
+                # Favor the long (Win32) name over the 8.3 one; parse_record noted where it is
+                name = record['fn', record.get('fnwin32', record['fncnt'] - 1)]['name']
+                self.mft_name[self.num_records] = intern_name(name, name)
+
+            if progress:
                 if self.num_records % (self.mftsize / 5) == 0 and self.num_records > 0:
                     print('Building Filepaths: {0:.0f}'.format(100.0 * self.num_records / self.mftsize) + '%')
 
             self.num_records += 1
 
-            raw_record = self.file_mft.read(1024)
-
         self.gen_filepaths()
 
     def get_folder_path(self, seqnum):
-        if self.debug:
-            print("Building Folder For Record Number (%d)" % seqnum)
-
-        if seqnum not in self.mft:
-            return 'Orphan'
+        filenames = self.mft_filename
+        par_refs = self.mft_par_ref
+        names = self.mft_name
+        path_sep = self.path_sep
+        debug = self.debug
+
+        # Follow the parent references up until we reach a record whose path is known or can be worked out
+        # on its own, then build the paths of the records we passed on the way back down. Every one of them
+        # is remembered, so later lookups for the same folders stop early.
+        chain = []
+        visited = set()
+        cur = seqnum
+        while True:
+            if debug:
+                print("Building Folder For Record Number (%d)" % cur)
+
+            if cur >= len(filenames):
+                path = 'Orphan'
+                break
+
+            # If we've already figured out the path name, just use it
+            if filenames[cur] != '':
+                path = filenames[cur]
+                break
+
+            par_ref = par_refs[cur]
+
+            # Without an FN record there is no parent sequence number to follow
+            if par_ref == NoParentRef:
+                filenames[cur] = 'NoFNRecord'
+                path = filenames[cur]
+                break
 
-        # If we've already figured out the path name, just return it
-        if (self.mft[seqnum]['filename']) != '':
-            return self.mft[seqnum]['filename']
-
-        try:
             # if (self.mft[seqnum]['fn',0]['par_ref'] == 0) or
             # (self.mft[seqnum]['fn',0]['par_ref'] == 5):  # There should be no seq
             # number 0, not sure why I had that check in place.
-            if self.mft[seqnum]['par_ref'] == 5:  # Seq number 5 is "/", root of the directory
-                self.mft[seqnum]['filename'] = self.path_sep + self.mft[seqnum]['name'].decode()
-                return self.mft[seqnum]['filename']
-        except:  # If there was an error getting the parent's sequence number, then there is no FN record
-            self.mft[seqnum]['filename'] = 'NoFNRecord'
-            return self.mft[seqnum]['filename']
-
-        # Self referential parent sequence number. The filename becomes a NoFNRecord note
-        if (self.mft[seqnum]['par_ref']) == seqnum:
-            if self.debug:
-                print("Error, self-referential, while trying to determine path for seqnum %s" % seqnum)
-            self.mft[seqnum]['filename'] = 'ORPHAN' + self.path_sep + self.mft[seqnum]['name'].decode()
-            return self.mft[seqnum]['filename']
-
-        # We're not at the top of the tree and we've not hit an error
-        parentpath = self.get_folder_path((self.mft[seqnum]['par_ref']))
-        self.mft[seqnum]['filename'] = parentpath + self.path_sep + self.mft[seqnum]['name'].decode()
-
-        return self.mft[seqnum]['filename']
+            if par_ref == 5:  # Seq number 5 is "/", root of the directory
+                try:
+                    filenames[cur] = path_sep + names[cur].decode()
+                except:  # If there was an error decoding the name, treat it as if there is no FN record
+                    filenames[cur] = 'NoFNRecord'
+                path = filenames[cur]
+                break
+
+            # Self referential parent sequence number. The filename becomes a NoFNRecord note
+            if par_ref == cur:
+                if debug:
+                    print("Error, self-referential, while trying to determine path for seqnum %s" % cur)
+                filenames[cur] = 'ORPHAN' + path_sep + names[cur].decode()
+                path = filenames[cur]
+                break
+
+            # Parent references that loop back on themselves further up are orphans too
+            if cur in visited:
+                if debug:
+                    print("Error, parent reference loop, while trying to determine path for seqnum %s" % cur)
+                path = 'ORPHAN'
+                break
+
+            # We're not at the top of the tree and we've not hit an error
+            chain.append(cur)
+            visited.add(cur)
+            cur = par_ref
+
+        for cur in reversed(chain):
+            path = path + path_sep + names[cur].decode()
+            filenames[cur] = path
+
+        return path
 
     def gen_filepaths(self):
+        filenames = self.mft_filename
+        par_refs = self.mft_par_ref
+        debug = self.debug
 
-        for i in self.mft:
+        for i in range(len(filenames)):
 
             #            if filename starts with / or ORPHAN, we're done.
             #            else get filename of parent, add it to ours, and we're done.
 
             # If we've not already calculated the full path ....
-            if (self.mft[i]['filename']) == '':
+            if filenames[i] == '':
 
-                if self.mft[i]['fncnt'] > 0:
+                if par_refs[i] != NoParentRef:
                     self.get_folder_path(i)
                     # self.mft[i]['filename'] = self.mft[i]['filename'] + '/' +
                     #   self.mft[i]['fn',self.mft[i]['fncnt']-1]['name']
                     # self.mft[i]['filename'] = self.mft[i]['filename'].replace('//','/')
-                    if self.debug:
-                        print("Filename (with path): %s" % self.mft[i]['filename'])
+                    if debug:
+                        print("Filename (with path): %s" % filenames[i])
                 else:
-                    self.mft[i]['filename'] = 'NoFNRecord'
+                    filenames[i] = 'NoFNRecord'
@@ -10,50 +10,69 @@
 #
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 
-# DevelNote: need to pass in localtz now
+# Windows FILETIME epoch; UTC times are computed from it with integer arithmetic
+WINDOWS_EPOCH = datetime(1601, 1, 1)
+
+
+# MFT timestamps repeat heavily (installers, volume creation, copies), so conversions are memoized
+@lru_cache(maxsize=1 << 16)
+def convert_filetime(timestamp, localtz):
+    """Return (datetime, string, unix time) for a Windows FILETIME"""
+
+    if timestamp == 0:
+        return 0, "Not defined", 0
+
+    # Windows NT time is specified as the number of 100 nanosecond intervals since January 1, 1601.
+    # UNIX time is specified as the number of seconds since January 1, 1970.
+    # There are 134,774 days (or 11,644,473,600 seconds) between these dates.
+    unixtime = timestamp * 1e-7 - 11644473600
+
+    try:
+        if localtz:
+            dt = datetime.fromtimestamp(unixtime)
+        else:
+            # Integer arithmetic on the FILETIME, exact to the microsecond
+            dt = WINDOWS_EPOCH + timedelta(microseconds=timestamp // 10)
+
+        # Pass isoformat a delimiter if you don't like the default "T".
+        return dt, dt.isoformat(' '), unixtime
+
+    except:
+        return 0, "Invalid timestamp", 0
+
 
 class WindowsTime:
     """Convert the Windows time in 100 nanosecond intervals since Jan 1, 1601 to time in seconds since Jan 1, 1970"""
 
+    # Several instances per record, so avoid a per-instance __dict__
+    __slots__ = ('low', 'high', 'localtz')
+
     def __init__(self, low, high, localtz):
-        self.low = int(low)
-        self.high = int(high)
-
-        if (low == 0) and (high == 0):
-            self.dt = 0
-            self.dtstr = "Not defined"
-            self.unixtime = 0
-            return
-
-        # Windows NT time is specified as the number of 100 nanosecond intervals since January 1, 1601.
-        # UNIX time is specified as the number of seconds since January 1, 1970.
-        # There are 134,774 days (or 11,644,473,600 seconds) between these dates.
-        self.unixtime = self.get_unix_time()
-
-        try:
-            if localtz:
-                self.dt = datetime.fromtimestamp(self.unixtime)
-            else:
-                self.dt = datetime.utcfromtimestamp(self.unixtime)
-
-            # Pass isoformat a delimiter if you don't like the default "T".
-            self.dtstr = self.dt.isoformat(' ')
-
-        except:
-            self.dt = 0
-            self.dtstr = "Invalid timestamp"
-            self.unixtime = 0
-
-    def get_unix_time(self):
-        t = float(self.high) * 2 ** 32 + self.low
-
-        # The '//' does a floor on the float value, where *1e-7 does not, resulting in an off by one second error
-        # However, doing the floor loses the usecs....
-        return t * 1e-7 - 11644473600
-        # return((t//10000000)-11644473600)
+        # low and high come straight out of struct.unpack, so they are already ints
+        self.low = low
+        self.high = high
+        self.localtz = localtz
+
+    # The conversion is deferred until a value is actually used. The filepath pass parses every record
+    # without looking at a single timestamp, and convert_filetime memoizes the work for the output pass.
+    @property
+    def dt(self):
+        return convert_filetime((self.high << 32) | self.low, self.localtz)[0]
+
+    @property
+    def dtstr(self):
+        return convert_filetime((self.high << 32) | self.low, self.localtz)[1]
+
+    @property
+    def unixtime(self):
+        return convert_filetime((self.high << 32) | self.low, self.localtz)[2]
+
+    def __str__(self):
+        return self.dtstr
 
 
 def hexdump(chars, sep, width):